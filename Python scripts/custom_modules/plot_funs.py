@@ -1,15 +1,22 @@
 import os
 import folium
 import io
+import time
+import atexit
 import base64
+import tempfile
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.ticker import FuncFormatter
 import plotly.express as px
+from functools import lru_cache
+from joblib import Parallel, delayed
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageColor
 from datetime import datetime
@@ -42,16 +49,51 @@ def plot_missing_rate(missing_rate, start_year, end_year, save_path, threshold=0
     if Path(save_path).exists():
       print(f"{save_path} exists and will not be updated.")
 
+def downsample_minmax(x, y, n_buckets):
+  """
+  Decimate a series for plotting by keeping the min and max sample of each bucket.
+  Peaks survive while the drawn line carries about two vertices per pixel column;
+  NaN gaps are preserved because the original samples are returned, not aggregates.
+  """
+  y = np.asarray(y, dtype=float)
+  n = len(y)
+  if n_buckets <= 0 or n <= 2 * n_buckets:
+    return x, y
+
+  size = n // n_buckets
+  m = size * n_buckets
+  buckets = y[:m].reshape(n_buckets, size)
+  offsets = np.arange(n_buckets) * size
+  # push NaNs out of the way of argmin/argmax; an all-NaN bucket keeps its NaN sample
+  idx_min = offsets + np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+  idx_max = offsets + np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+  idx = np.union1d(idx_min, idx_max)
+  if m < n:  # keep the tail samples that did not fill a bucket
+    idx = np.concatenate((idx, np.arange(m, n)))
+  return x[idx], y[idx]
+
 # plot whole sensors data in a same plot
 def plot_time_series_data(df, start_year, end_year, save_path, title_prefix="Time Series of Sensor Hourly Counts", rewrite=True):
   """
   Plot the time series data for sensors and save the figure.
   """
   if rewrite == True or not save_path.exists():
-    fig, ax = plt.subplots(figsize=(50, 20))
+    # build the figure on the Agg canvas directly, skipping the pyplot figure manager
+    fig = Figure(figsize=(50, 20))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+
+    # about two vertices per pixel column is all the renderer can show
+    n_buckets = 2 * int(fig.get_figwidth() * fig.dpi)
 
-    for sensor in df.index:
-      ax.plot(df.columns, df.loc[sensor], label=sensor)
+    # one transpose up front makes each sensor a contiguous column slice
+    # instead of a row copy per sensor
+    df_t = df.transpose()
+
+    for sensor in df_t.columns:
+      xs, ys = downsample_minmax(df_t.index, df_t[sensor], n_buckets)
+      # rasterize the dense hourly lines so they go straight through Agg instead of the vector path
+      ax.plot(xs, ys, label=sensor, rasterized=True)
 
     ax.set_title(f'{title_prefix} for {start_year}-{end_year}', fontsize=20)
     ax.set_ylabel('Hourly Counts', fontsize=20)
@@ -61,8 +103,7 @@ def plot_time_series_data(df, start_year, end_year, save_path, title_prefix="Tim
     ax.legend(title='Sensor Name', bbox_to_anchor=(1.02, 1), loc='upper left', fontsize=20)
 
     save_path = os.path.join(save_path, f'time_series_data_{start_year}_{end_year}.png')
-    plt.savefig(save_path, bbox_inches='tight', pad_inches=0.1)
-    plt.close()
+    fig.savefig(save_path, bbox_inches='tight', pad_inches=0.1)
 
     if Path(save_path).exists():
       print(f"{save_path} updated.")
@@ -85,7 +126,9 @@ def plot_time_series_data_sensor(df, start_year, end_year,
   show_week = False
   if rewrite or not Path(save_path).exists():
     try:
-      df.columns = pd.to_datetime(df.columns)
+      # the labels are pandas-written ISO timestamps; naming the format skips
+      # the per-element dateutil inference fallback
+      df.columns = pd.to_datetime(df.columns, format='ISO8601')
     except:
       show_week = True  # the scale = 'day_hour' or 'hour_day'
       pass
@@ -101,36 +144,66 @@ def plot_time_series_data_sensor(df, start_year, end_year,
       cols -= 2
       rows = int(np.ceil(num_sensors / cols))
 
-  for shade_missing in with_shadow_missing:
-    fig, axes = plt.subplots(rows, cols, figsize=(40, 20), constrained_layout=True, sharex=True)
+    # one transpose up front makes each sensor a contiguous column slice
+    # instead of a row copy per sensor
+    df_t = df.transpose()
+
+    # compute the missing-value mask once, instead of per sensor per shade mode
+    missing_df = df_t.isna()
+
+    # build the subplot grid once and reuse it for both shade modes, instead of
+    # paying rows x cols Axes setup per mode
+    fig = Figure(figsize=(40, 20), layout='constrained')
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(rows, cols, sharex=True)
     print(rows, cols)
 
     if num_sensors == 1:
       axes = np.array([[axes]])
 
-    for i, sensor in enumerate(df.index):
-      ax = axes[i // cols, i % cols]
-      data = df.loc[sensor]
-      ax.plot(data.index, data, lw=1)
+    axes_flat = list(axes.flat)
+    last_row_start = (rows - 1) * cols
+
+    shade_runs = []  # (ax, intervals) per sensor, overlaid only for the shaded save
+
+    # sampling step of the time axis, used to extend each missing run through its last sample
+    col_step = np.min(np.diff(df_t.index.values)) if not show_week and len(df_t.index) > 1 else 0
+
+    # each subplot is roughly fig_width / cols wide; two vertices per pixel column
+    n_buckets = 2 * int(fig.get_figwidth() * fig.dpi / cols)
+
+    for i, (ax, sensor) in enumerate(zip(axes_flat, df_t.columns)):
+      data = df_t[sensor]
+      if show_week:
+        xs, ys = data.index, data  # the weekday tick labels need every category on the axis
+      else:
+        xs, ys = downsample_minmax(data.index, data, n_buckets)
+      ax.plot(xs, ys, lw=1)
       title = sensor
       new_title = title.split('|')[-1] if '|' in title else title
       ax.set_title(new_title.strip(), fontsize=20)
 
-      if shade_missing:
-        missing_data = pd.isna(data)
+      if True in with_shadow_missing:
+        missing_data = missing_df[sensor]
         if missing_data.any():
-          start_dates = data.index[missing_data & ~missing_data.shift(1).fillna(False)]
-          end_dates = data.index[missing_data & ~missing_data.shift(-1).fillna(False)]
-          for start, end in zip(start_dates, end_dates):
-            ax.add_patch(patches.Rectangle((start, ax.get_ylim()[0]), end - start, ax.get_ylim()[1] - ax.get_ylim()[0], fill=True, color='orange', alpha=0.2))
+          # locate run starts/ends with one diff pass instead of two shifted copies
+          mask = missing_data.to_numpy().view(np.int8)
+          edges = np.diff(np.concatenate(([0], mask, [0])))
+          start_dates = data.index.values[np.flatnonzero(edges == 1)]
+          end_dates = data.index.values[np.flatnonzero(edges == -1) - 1]
+          # one collection holding every interval is far cheaper to draw than one Rectangle artist per run;
+          # the edge diff already coalesces consecutive missing samples into maximal runs, and adding
+          # col_step spans each run through its last sample so single-point gaps stay visible
+          intervals = [(start, end - start + col_step) for start, end in zip(start_dates, end_dates)]
+          shade_runs.append((ax, intervals))
 
       ax.tick_params(axis='y', labelsize=20)
-      
-      if i // cols != rows - 1:
+
+      if i < last_row_start:
         ax.tick_params(axis='x', which='both', bottom=False, top=False, labelbottom=False)
       else:
         ax.tick_params(axis='x', labelsize=20, rotation=90)
-      
+
       if show_week:
         days = [t.split()[0] for t in data.index]
         day_indices = [idx for idx, (d1, d2) in enumerate(zip(days, days[1:])) if d1 != d2]
@@ -141,48 +214,76 @@ def plot_time_series_data_sensor(df, start_year, end_year,
         ax.set_xticklabels([days[k] for k in day_indices], rotation=90, ha='center')
 
         # ax.xaxis.set_major_locator(plt.MaxNLocator(7))
-       
-    for i in range(num_sensors, rows * cols):
-      axes[i // cols, i % cols].axis('off')
+
+    # hidden axes are skipped by the draw pass entirely, unlike axis('off')
+    for ax in axes_flat[num_sensors:]:
+      ax.set_visible(False)
 
     if start_year != end_year:
       fig.suptitle(f'{title_prefix} for {start_year}-{end_year}', fontsize=25)
     else:
       fig.suptitle(f'{title_prefix} for {start_year}', fontsize=25)
 
-    suffix = 'with_shade' if shade_missing else 'without_shade'
-    if start_year != end_year:
-      final_path = os.path.join(save_path, f'{fig_name}_{start_year}_{end_year}_{suffix}.png')
-    else:
-      final_path = os.path.join(save_path, f'{fig_name}_{start_year}_{suffix}.png')
+    def save_fig(suffix):
+      if start_year != end_year:
+        final_path = os.path.join(save_path, f'{fig_name}_{start_year}_{end_year}_{suffix}.png')
+      else:
+        final_path = os.path.join(save_path, f'{fig_name}_{start_year}_{suffix}.png')
 
-    plt.savefig(final_path, bbox_inches='tight', pad_inches=0.1)
-    plt.close()
-    if Path(final_path).exists():
-      print(f"{final_path} updated.")
-    else:
-      print(f"{final_path} saved.")
+      fig.savefig(final_path, bbox_inches='tight', pad_inches=0.1)
+      if Path(final_path).exists():
+        print(f"{final_path} updated.")
+      else:
+        print(f"{final_path} saved.")
+
+    if False in with_shadow_missing:
+      save_fig('without_shade')
+
+    if True in with_shadow_missing:
+      for ax, intervals in shade_runs:
+        ylo, yhi = ax.get_ylim()  # probe the autoscaled limits once per sensor
+        ax.broken_barh(intervals, (ylo, yhi - ylo), facecolor='orange', alpha=0.2)
+      save_fig('with_shade')
   else:
     if Path(save_path).exists():
       print(f"{save_path} exists and will not be updated.")
 
+def resample_monthly(df):
+  return df.groupby('New_Sensor_Name').resample('M').sum(numeric_only=True).reset_index()
+
 def plot_time_series_data_iterative(df, save_path, start_year=None, end_year=None, aggregate_by_month=False, rewrite=True):
   if rewrite == True or not save_path.exists():
     df = df.copy()
-    num_sensors = len(pd.unique(df['New_Sensor_Name']))
+    sensor_names = pd.unique(df['New_Sensor_Name'])
+    num_sensors = len(sensor_names)
     cols = int(np.ceil(np.sqrt(num_sensors)))
 
     if aggregate_by_month:
       df.set_index('Date_Time', inplace=True)
-      df = df.groupby('New_Sensor_Name').resample('M').sum(numeric_only=True).reset_index()
-      df['Date_Time'] = df['Date_Time'].dt.to_period('M')
-      df['Date_Time'] = df['Date_Time'].dt.strftime('%Y-%m')
+      # chunks of ~100 sensors keep the joblib dispatch overhead small relative
+      # to each task; when everything fits in one chunk, worker spawn and frame
+      # pickling would only add overhead, so resample in-process
+      chunk_size = 100
+      if num_sensors <= chunk_size:
+        df = resample_monthly(df)
+      else:
+        # chunk over sorted names so the concatenated result keeps the global
+        # key order a plain groupby would produce
+        sorted_names = np.sort(sensor_names)
+        chunks = [sorted_names[i:i + chunk_size] for i in range(0, num_sensors, chunk_size)]
+        resampled = Parallel(n_jobs=-1)(
+          delayed(resample_monthly)(df[df['New_Sensor_Name'].isin(chunk)]) for chunk in chunks
+        )
+        df = pd.concat(resampled, ignore_index=True)
+      # one accessor chain: astype(str) on monthly periods already yields 'YYYY-MM'
+      df['Date_Time'] = df['Date_Time'].dt.to_period('M').astype(str)
 
     fig = px.line(df, x="Date_Time", y="Hourly_Counts", facet_col="New_Sensor_Name",
                   facet_col_wrap=cols,
                   facet_row_spacing=0.03, # default is 0.07 when facet_col_wrap is used
                   facet_col_spacing=0.03, # default is 0.03
                   height=1500, width=2000,
+                  render_mode='webgl', # Scattergl traces; SVG paths choke the browser at this point count
                   title="Time Series of Sensor Hourly Counts")
     fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
     fig.update_yaxes(showticklabels=True, matches=None)
@@ -216,7 +317,11 @@ def plot_best_k(df_scores, save_path):
   db_scores = df_scores['Davies_Bouldin'].values.tolist()
   ch_scores = df_scores['Calinski_Harabasz'].values.tolist()
   
-  fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(12, 8))
+  # constrained layout is solved during the draw pass, replacing the extra
+  # tight_layout bbox walk over every annotation arrow
+  fig = Figure(figsize=(12, 8), layout='constrained')
+  FigureCanvasAgg(fig)
+  (ax1, ax2), (ax3, ax4) = fig.subplots(2, 2)
   
   def plot_subplot(ax, scores, title, xlabel, ylabel, xytext_offset, is_higher_better=True, is_elbow=False):
     if is_elbow:
@@ -254,10 +359,44 @@ def plot_best_k(df_scores, save_path):
                'The Calinski-Harabasz Index showing the optimal k', 'Number of clusters', 'Calinski-Harabasz Index', 
                (2, 0))
   
-  plt.tight_layout()
-  plt.subplots_adjust(hspace=0.3)
-  plt.savefig(save_path / 'plot_best_k.png', dpi=800, bbox_inches='tight', pad_inches=0.1)
-  plt.show()
+  fig.savefig(save_path / 'plot_best_k.png', dpi=800, bbox_inches='tight', pad_inches=0.1)
+
+# shared headless browser for map rasterization, started on first use
+_map_png_driver = None
+
+def _quit_map_png_driver():
+  if _map_png_driver is not None:
+    _map_png_driver.quit()
+
+atexit.register(_quit_map_png_driver)
+
+def map_to_png(m, delay=5):
+  """
+  Rasterize a folium map to PNG bytes with a shared headless browser.
+  folium's _to_png launches (and quits) a fresh browser per call, which
+  dominates the wall-clock time when several maps are exported in one run;
+  reusing one driver leaves only the actual page render per map.
+  """
+  global _map_png_driver
+  from selenium import webdriver  # only needed for PNG export, like folium's own _to_png
+
+  if _map_png_driver is None:
+    options = webdriver.FirefoxOptions()
+    options.add_argument('--headless')
+    _map_png_driver = webdriver.Firefox(options=options)
+    _map_png_driver.set_window_size(1400, 1000)  # fixed size keeps PNG dimensions deterministic
+
+  # serve the page from a temp file like folium does; Firefox blocks top-level
+  # navigation to data: URLs
+  with tempfile.NamedTemporaryFile(mode='w', suffix='.html', encoding='utf-8', delete=False) as f:
+    f.write(m.get_root().render())
+    html_path = f.name
+  try:
+    _map_png_driver.get('file://' + html_path)
+    time.sleep(delay)  # give Leaflet time to fetch and draw the tiles
+    return _map_png_driver.get_screenshot_as_png()
+  finally:
+    os.remove(html_path)
 
 def plot_map(data, save_path, save_name=None):
   df = data.copy()
@@ -323,7 +462,7 @@ def plot_map(data, save_path, save_name=None):
   m.fit_bounds([(min(latitudes), min(longitudes)), (max(latitudes), max(longitudes))])
   m_png.fit_bounds([(min(latitudes), min(longitudes)), (max(latitudes), max(longitudes))])
 
-  img_data = m_png._to_png(5)
+  img_data = map_to_png(m_png, 5)
   img = Image.open(io.BytesIO(img_data))
 
   if save_name is None:
@@ -384,11 +523,24 @@ def create_icon(gradient_color, opacity_value):
   draw.ellipse([(2, 2), (28, 28)], fill=(*gradient_color, int(255 * opacity_value)))
   
   buffered = io.BytesIO()
-  image.save(buffered, format="PNG")
+  # low compression: zlib at the default level dominates the encode time,
+  # and a 30x30 icon saves nothing worthwhile from compressing harder
+  image.save(buffered, format="PNG", compress_level=1)
   img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
     
   return f"data:image/png;base64,{img_str}"
 
+@lru_cache(maxsize=4096)
+def create_icon_cached(base_color, factor):
+  """
+  Build the icon for a quantized value/max_value ratio.
+  Markers whose ratios fall in the same 0.01 bucket are visually identical,
+  so the PIL draw + PNG encode runs once per (color, bucket) instead of per marker.
+  """
+  gradient_color = get_gradient_color(base_color, factor, 1)
+  opacity_value = get_opacity(factor, 1)
+  return create_icon(gradient_color, opacity_value)
+
 def plot_map_gradient_color(data, save_path):
   df = data.copy()
 
@@ -398,7 +550,8 @@ def plot_map_gradient_color(data, save_path):
     grouped_df = df.groupby(['New_Sensor_Name', 'Clusters'])
 
   m = folium.Map(location=[df['Latitude'].mean(), df['Longitude'].mean()], zoom_start=15)
-  m_png = folium.Map(width=1300, height=900, location=[df['Latitude'].mean(), df['Longitude'].mean()], zoom_start=15)
+  # markers are built once into one group, shared by the HTML map and the PNG map
+  markers = folium.FeatureGroup(name='sensors')
 
   # colors = [
   #   'red', 'blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 
@@ -420,13 +573,14 @@ def plot_map_gradient_color(data, save_path):
     group_max_value = df_subset['total_counts'].max()
     base_color = colors[cluster % len(colors)]
 
-    for _, row in group_data.iterrows():
-      lat = row['Latitude']
-      long = row['Longitude']
-      value = row['total_counts']
-      gradient_color = get_gradient_color(base_color, value, group_max_value)
-      opacity_value = get_opacity(value, group_max_value)
-      icon_image = create_icon(gradient_color, opacity_value)
+    # quantize the whole group's value/max ratios in one broadcast instead of per-row Python math
+    values = group_data['total_counts'].to_numpy()
+    factors = np.round(values / group_max_value, 2)
+
+    # itertuples yields plain tuples; iterrows built a fresh Series per row
+    coords = group_data[['Latitude', 'Longitude']].itertuples(index=False, name=None)
+    for (lat, long), value, factor in zip(coords, values, factors):
+      icon_image = create_icon_cached(base_color, factor)
 
       # folium.CircleMarker(
       #     location=[lat, long],
@@ -443,24 +597,23 @@ def plot_map_gradient_color(data, save_path):
         popup=f"Sensor: {sensor_name}, Cluster: {cluster}, Counts: {value}",
         # icon=folium.Icon(color=base_color, icon='info-sign', prefix='glyphicon')
         icon=folium.CustomIcon(icon_image=icon_image, icon_size=(30, 30))
-      ).add_to(m)
-
-      folium.Marker(
-        [lat, long],
-        popup=f"Sensor: {sensor_name}, Cluster: {cluster}, Counts: {value}",
-        # icon=folium.Icon(color=base_color, icon='info-sign', prefix='glyphicon')
-        icon=folium.CustomIcon(icon_image=icon_image, icon_size=(30, 30))
-      ).add_to(m_png)
+      ).add_to(markers)
 
       latitudes.append(lat)
       longitudes.append(long)
 
+  markers.add_to(m)  # one tree insert for the whole group instead of one per marker
+
   m.fit_bounds([(min(latitudes), min(longitudes)), (max(latitudes), max(longitudes))])
-  m_png.fit_bounds([(min(latitudes), min(longitudes)), (max(latitudes), max(longitudes))])
   m.save(str(save_path / 'map.html'))
   print("map.html saved.")
 
-  img_data = m_png._to_png(5)
+  # a fixed viewport only for the rasterized output; the HTML map above stays full-window
+  m_png = folium.Map(width=1300, height=900, location=[df['Latitude'].mean(), df['Longitude'].mean()], zoom_start=15)
+  markers.add_to(m_png)
+  m_png.fit_bounds([(min(latitudes), min(longitudes)), (max(latitudes), max(longitudes))])
+
+  img_data = map_to_png(m_png, 5)
   img = Image.open(io.BytesIO(img_data))
   img.save(str(save_path / 'map.png'))
   print("map.png saved.")